@@ -1,17 +1,26 @@
 import os
+import gzip
+import hashlib
+import json
+import mimetypes
 import subprocess
 import sqlite3
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+import time
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_socketio import SocketIO, emit
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
+from sqlalchemy.exc import OperationalError
+from rates import convert_usd_to_btc
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # --- App Initialization ---
-app = Flask(__name__)
+# Static files are served by serve_static() below with long-lived caching headers
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = 'a_very_secret_key_that_should_be_changed'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///rootzsu_bot.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -24,6 +33,106 @@ login_manager.login_view = 'login'
 # --- Global State ---
 bot_process = None
 
+# --- Cached Assets ---
+STATIC_DIR = os.path.join(app.root_path, 'static')
+AVATAR_DIR = os.path.join(app.root_path, 'avatar_cache')
+ASSET_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg')
+AVATAR_COLORS = ['#0d6efd', '#6610f2', '#6f42c1', '#d63384', '#dc3545', '#fd7e14', '#198754', '#20c997', '#0dcaf0']
+
+_digest_cache = {}
+
+def file_digest(path):
+    """Returns the sha256 of a file, memoized by path and mtime."""
+    mtime = os.path.getmtime(path)
+    cached = _digest_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _digest_cache[path] = (mtime, digest)
+    return digest
+
+def precompress(path):
+    """Writes a gzip variant next to the file unless an up-to-date one exists.
+
+    Returns False if the variant is missing and cannot be written (e.g. a read-only deploy).
+    """
+    gz_path = path + '.gz'
+    if os.path.exists(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(path):
+        return True
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        tmp_path = f'{gz_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        os.replace(tmp_path, gz_path)
+    except OSError as e:
+        print(f"Could not precompress {path}: {e}")
+        return False
+    return True
+
+def precompress_static():
+    for root, _, files in os.walk(STATIC_DIR):
+        for name in files:
+            if name.endswith(COMPRESSIBLE_EXTENSIONS):
+                precompress(os.path.join(root, name))
+
+def send_cached_file(directory, filename):
+    """Sends a file with a strong content ETag, far-future caching and its gzip variant when accepted."""
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    etag = file_digest(path)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    gz_path = path + '.gz'
+    # precompress() is a cheap mtime check that rebuilds the variant if the file was edited
+    if 'gzip' in request.accept_encodings and path.endswith(COMPRESSIBLE_EXTENSIONS) and precompress(path):
+        response = send_file(gz_path, mimetype=mimetype, etag=etag + '-gz', conditional=True,
+                             max_age=ASSET_MAX_AGE, download_name=os.path.basename(path))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_file(path, mimetype=mimetype, etag=etag, conditional=True, max_age=ASSET_MAX_AGE)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.immutable = True
+    return response
+
+def avatar_initials(name):
+    parts = (name or '').split()
+    initials = ''.join(part[0] for part in parts[:2]).upper()
+    return initials or '?'
+
+def get_avatar(name):
+    """Generates an initials SVG avatar on disk (once per name) and returns its cache key."""
+    key = hashlib.sha256((name or '').encode('utf-8')).hexdigest()[:32]
+    path = os.path.join(AVATAR_DIR, f'{key}.svg')
+    if not os.path.exists(path):
+        os.makedirs(AVATAR_DIR, exist_ok=True)
+        color = AVATAR_COLORS[int(key, 16) % len(AVATAR_COLORS)]
+        initials = avatar_initials(name).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        svg = (
+            '<svg xmlns="http://www.w3.org/2000/svg" width="80" height="80" viewBox="0 0 80 80">'
+            f'<rect width="80" height="80" fill="{color}"/>'
+            '<text x="50%" y="50%" dy=".35em" text-anchor="middle" fill="#fff" '
+            f'font-family="Arial, Helvetica, sans-serif" font-size="32">{initials}</text>'
+            '</svg>'
+        )
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(svg)
+        os.replace(tmp_path, path)
+        precompress(path)
+    return key
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    # Versioned URLs let browsers keep static files for a year and still pick up changes
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        path = safe_join(STATIC_DIR, values['filename'])
+        if path and os.path.isfile(path):
+            values['v'] = file_digest(path)[:12]
+
 # --- Database Models ---
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -55,10 +164,94 @@ class Order(db.Model):
     user = db.relationship('User', backref='orders')
     service = db.relationship('Service', backref='orders')
 
+class ExchangeRate(db.Model):
+    __tablename__ = 'exchange_rates'
+    currency = db.Column(db.String, primary_key=True)
+    rate = db.Column(db.Float, nullable=False)
+    source = db.Column(db.String)
+    updated_at = db.Column(db.Float, nullable=False)
+
+    @property
+    def age(self):
+        return time.time() - self.updated_at
+
+# Same settings (and defaults) as the bot uses for BTC pricing
+BTC_RATE_MAX_AGE = int(os.getenv('BTC_RATE_MAX_AGE', '900'))
+BTC_PRICE_DECIMALS = int(os.getenv('BTC_PRICE_DECIMALS', '8'))
+
+def get_btc_rate():
+    """Returns the bot's last BTC rate, or None if the bot has not stored one yet."""
+    try:
+        return ExchangeRate.query.get('BTC')
+    except OperationalError:
+        # exchange_rates is created by bot.py; it may not have run against this database yet
+        db.session.rollback()
+        return None
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+# --- Service Catalog Cache ---
+# The public catalog is served from memory; SQLite is only read when the
+# catalog is rebuilt (on update_service and by a periodic background refresh
+# that picks up price_btc changes written by the bot).
+CATALOG_REFRESH_INTERVAL = int(os.getenv('CATALOG_REFRESH_INTERVAL', '60'))
+catalog = {'services': [], 'body': None, 'etag': None, 'version': 0, 'expires_at': None}
+
+def refresh_catalog():
+    """Rebuilds the cached catalog JSON; bumps the version only if the content changed.
+
+    BTC prices are published only while the bot's rate is fresh; the catalog
+    expires together with the rate so a stale price is never served.
+    """
+    global catalog
+    try:
+        rows = Service.query.order_by(Service.service_id).all()
+    except OperationalError:
+        # services is created by bot.py; serve an empty catalog until it has run
+        db.session.rollback()
+        rows = []
+    btc_rate = get_btc_rate()
+    rate_fresh = btc_rate is not None and btc_rate.age <= BTC_RATE_MAX_AGE
+    expires_at = btc_rate.updated_at + BTC_RATE_MAX_AGE if rate_fresh else None
+    services = [
+        {
+            'id': s.service_id,
+            'name': s.name,
+            'description': s.description,
+            'price_usd': s.price_usd,
+            'price_btc': s.price_btc if rate_fresh else None,
+            'price_stars': s.price_stars,
+        }
+        for s in rows
+    ]
+    body = json.dumps({'services': services}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    if etag != catalog['etag']:
+        # Swap the whole dict so readers never see a half-updated catalog
+        catalog = {'services': services, 'body': body, 'etag': etag, 'version': catalog['version'] + 1,
+                   'expires_at': expires_at}
+    elif expires_at != catalog['expires_at']:
+        catalog = dict(catalog, expires_at=expires_at)
+    return catalog
+
+def get_catalog():
+    if catalog['body'] is None:
+        return refresh_catalog()
+    if catalog['expires_at'] is not None and time.time() > catalog['expires_at']:
+        return refresh_catalog()
+    return catalog
+
+def catalog_refresher():
+    while True:
+        socketio.sleep(CATALOG_REFRESH_INTERVAL)
+        with app.app_context():
+            try:
+                refresh_catalog()
+            except Exception as e:
+                print(f"Catalog refresh failed: {e}")
+
 # --- Bot Management ---
 def is_bot_running():
     global bot_process
@@ -84,7 +277,16 @@ def stop_bot():
 # --- General Routes ---
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', services=get_catalog()['services'])
+
+@app.route('/static/<path:filename>')
+def static(filename):
+    return send_cached_file(STATIC_DIR, filename)
+
+@app.route('/avatar/<key>.svg')
+@login_required
+def avatar(key):
+    return send_cached_file(AVATAR_DIR, f'{key}.svg')
 
 # --- User Authentication Routes ---
 @app.route('/register', methods=['GET', 'POST'])
@@ -140,8 +342,7 @@ def logout():
 @login_required
 def dashboard():
     user_orders = Order.query.filter_by(user_id=current_user.user_id).order_by(Order.order_id.desc()).all()
-    # Placeholder for profile photo logic
-    profile_photo = f"https://api.dicebear.com/8.x/initials/svg?seed={current_user.first_name}"
+    profile_photo = url_for('avatar', key=get_avatar(current_user.first_name))
     return render_template('dashboard.html', orders=user_orders, photo=profile_photo)
 
 # --- Admin Routes ---
@@ -172,15 +373,28 @@ def admin_panel():
     all_users = User.query.all()
     all_services = Service.query.all()
     all_orders = Order.query.all()
+    btc_rate = get_btc_rate()
 
     return render_template(
         'admin_panel.html', 
         users=all_users, 
         services=all_services,
         orders=all_orders,
+        btc_rate=btc_rate,
         bot_status=is_bot_running()
     )
 
+# --- Public API Routes ---
+@app.route('/api/services')
+def api_services():
+    current = get_catalog()
+    response = app.response_class(current['body'], mimetype='application/json')
+    response.set_etag(current['etag'])
+    response.headers['X-Catalog-Version'] = str(current['version'])
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 # --- API Routes for Admin Panel ---
 @app.route('/admin/api/service/update', methods=['POST'])
 @login_required
@@ -189,12 +403,23 @@ def update_service():
     data = request.json
     service = Service.query.get(data['id'])
     if service:
+        try:
+            price_usd = float(data['price_usd'])
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Price USD must be a number'}), 400
         service.name = data['name']
         service.description = data['description']
-        service.price_usd = data['price_usd']
-        service.price_btc = data['price_btc']
+        service.price_usd = price_usd
         service.price_stars = data['price_stars']
+        # price_btc is derived from price_usd using the bot's last known BTC rate;
+        # with a stale rate it is cleared until the bot recomputes it on its next refresh
+        btc_rate = get_btc_rate()
+        if btc_rate and btc_rate.age <= BTC_RATE_MAX_AGE:
+            service.price_btc = convert_usd_to_btc(service.price_usd, btc_rate.rate, BTC_PRICE_DECIMALS)
+        else:
+            service.price_btc = None
         db.session.commit()
+        refresh_catalog()
         return jsonify({'success': True})
     return jsonify({'success': False, 'error': 'Service not found'}), 404
 
@@ -214,5 +439,7 @@ def handle_toggle_bot():
 
 # --- Main Entry ---
 if __name__ == '__main__':
+    precompress_static()
+    socketio.start_background_task(catalog_refresher)
     socketio.run(app, debug=True, port=5000)
 
@@ -0,0 +1,408 @@
+"""Benchmarks for every SQL path run by bot.py and app.py.
+
+Seeds synthetic databases with the bot's own schema, times each query the
+handlers run, records EXPLAIN QUERY PLAN output and compares both against a
+saved baseline.
+
+    python benchmarks/bench_queries.py --save-baseline      # record a baseline
+    python benchmarks/bench_queries.py                      # compare against it
+    python benchmarks/bench_queries.py --sizes 1000,100000  # skip the 1M database
+
+Exits with status 1 when a query is slower than the baseline by more than
+--tolerance, when its plan contains a full table scan the baseline did not,
+or when a query marked 'indexed' scans a whole table (checked with or without
+a baseline).
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BENCH_DIR, '.data')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+ORDERS_PER_USER = 10
+PAYMENT_METHODS = ['USD', 'BTC', 'STARS']
+STATUSES = ['pending_payment', 'pending_approval', 'approved', 'declined']
+SEED_VERSION = 1  # Bump when the synthetic data changes in a way the source hash cannot see
+
+
+# --- Database seeding ---
+def seed_database(path, orders):
+    """Creates the bot schema at path and fills it with synthetic users and orders."""
+    bot.DB_PATH = path
+    bot.setup_database()
+    bot.add_initial_services()
+
+    rng = random.Random(42)
+    users = max(1, orders // ORDERS_PER_USER)
+    conn = sqlite3.connect(path)
+    service_ids = [row[0] for row in conn.execute("SELECT service_id FROM services")]
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+        ((user_id, f"user{user_id}", f"User {user_id}") for user_id in range(1, users + 1))
+    )
+    conn.executemany(
+        "INSERT INTO orders (user_id, service_id, payment_method, status, payment_proof) VALUES (?, ?, ?, ?, ?)",
+        generate_orders(rng, orders, users, service_ids)
+    )
+    conn.commit()
+    conn.close()
+
+
+def generate_orders(rng, orders, users, service_ids):
+    open_orders = set()
+    for i in range(orders):
+        user_id, service_id = rng.randint(1, users), rng.choice(service_ids)
+        status = rng.choice(STATUSES)
+        payment_method = rng.choice(PAYMENT_METHODS)
+        # The schema allows only one pending_payment order per user, service and payment method
+        if status == 'pending_payment':
+            if (user_id, service_id, payment_method) in open_orders:
+                status = 'approved'
+            open_orders.add((user_id, service_id, payment_method))
+        yield (user_id, service_id, payment_method, status,
+               f"file_{i}" if rng.random() < 0.5 else None)
+
+
+def schema_hash():
+    """Hash of the schema and seeding code, so a changed schema gets a freshly seeded database."""
+    source = ''.join(inspect.getsource(func) for func in (
+        bot.setup_database, bot.add_initial_services, seed_database, generate_orders))
+    return hashlib.sha256(f"{SEED_VERSION}:{source}".encode('utf-8')).hexdigest()[:12]
+
+
+def get_database(orders):
+    """Returns the path of a seeded database, reusing one from a previous run with the same schema."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, f"orders_{orders}_{schema_hash()}.db")
+    if not os.path.exists(path):
+        print(f"Seeding {orders} orders...")
+        seed_database(path + '.tmp', orders)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+# --- Query paths ---
+# Each benchmark is a list of steps (sql, params) where params(ctx) returns the
+# parameter tuples to execute the statement with. The SQL mirrors what the
+# handlers run; for app.py it is the SQL that SQLAlchemy emits.
+# Write benchmarks run in a transaction that is rolled back after each run, so
+# every run writes to the same fresh row and the cached database never changes.
+# A write that must change a row fails the run if it does not; an optional third
+# step element False marks a write that is expected to change nothing (INSERT OR
+# IGNORE hitting an existing order).
+# 'indexed' benchmarks serve a single user or order and must never scan a whole table.
+def one_user(ctx):
+    return [(ctx['user_id'],)]
+
+def dashboard_services(ctx):
+    # Lazy loading order.service hits the DB once per distinct service (identity map)
+    return [(service_id,) for service_id in ctx['user_service_ids']]
+
+BENCHMARKS = {
+    'start_upsert': {
+        'source': 'bot.start',
+        'write': True,
+        'steps': [
+            # A first /start: the SELECT finds nothing and the user is inserted
+            ("SELECT * FROM users WHERE user_id = ?", lambda ctx: [(ctx['new_user_id'],)]),
+            ("INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+             lambda ctx: [(ctx['new_user_id'], f"user{ctx['new_user_id']}", f"User {ctx['new_user_id']}")]),
+        ],
+        'indexed': True,
+    },
+    'payment_selection_new': {
+        'source': 'bot.process_payment_selection',
+        'write': True,
+        'steps': [
+            # First BTC order for this user and service: a new row with the quoted price
+            ("INSERT OR IGNORE INTO orders (user_id, service_id, payment_method, price_btc, btc_rate) "
+             "VALUES (?, ?, ?, ?, ?)", lambda ctx: [(ctx['new_user_id'], 1, 'BTC', 0.0003, 50000.0)]),
+        ],
+        'indexed': True,
+    },
+    'payment_selection_reuse': {
+        'source': 'bot.process_payment_selection',
+        'write': True,
+        'steps': [
+            # Repeated choice of an open order: the insert is ignored, the order is re-quoted
+            ("INSERT OR IGNORE INTO orders (user_id, service_id, payment_method, price_btc, btc_rate) "
+             "VALUES (?, ?, ?, ?, ?)",
+             lambda ctx: [ctx['pending_order_key'] + (0.0003, 50000.0)], False),
+            ("SELECT order_id FROM orders WHERE user_id = ? AND service_id = ? AND payment_method = ? "
+             "AND status = 'pending_payment'", lambda ctx: [ctx['pending_order_key']]),
+            ("UPDATE orders SET price_btc = ?, btc_rate = ? WHERE order_id = ?",
+             lambda ctx: [(0.0003, 50000.0, ctx['pending_order_id'])]),
+        ],
+        'indexed': True,
+    },
+    'my_account': {
+        'source': 'bot.my_account',
+        'steps': [
+            ("""
+        SELECT o.order_id, o.status, s.name
+        FROM orders o
+        JOIN services s ON o.service_id = s.service_id
+        WHERE o.user_id = ?
+    """, one_user),
+        ],
+        'indexed': True,
+    },
+    'admin_view_orders': {
+        'source': 'bot.admin_view_orders',
+        'steps': [
+            ("""
+        SELECT o.order_id, o.user_id, o.status, s.name, u.first_name, u.username
+        FROM orders o
+        JOIN services s ON o.service_id = s.service_id
+        JOIN users u ON o.user_id = u.user_id
+    """, lambda ctx: [()]),
+        ],
+    },
+    'upload_proof': {
+        'source': 'bot.upload_proof',
+        'write': True,
+        'steps': [
+            ("UPDATE orders SET payment_proof = ?, status = 'pending_approval' WHERE order_id = ? "
+             "AND status = 'pending_payment'",
+             lambda ctx: [(f"file_{ctx['pending_order_id']}", ctx['pending_order_id'])]),
+            ("SELECT s.name, o.payment_method, o.price_btc, o.btc_rate FROM services s "
+             "JOIN orders o ON s.service_id = o.service_id WHERE o.order_id = ?",
+             lambda ctx: [(ctx['pending_order_id'],)]),
+        ],
+        'indexed': True,
+    },
+    'admin_handle_order': {
+        'source': 'bot.admin_handle_order',
+        'write': True,
+        'steps': [
+            ("UPDATE orders SET status = ? WHERE order_id = ? AND status IN ('pending_payment', 'pending_approval')",
+             lambda ctx: [('approved', ctx['pending_order_id'])]),
+            ("SELECT user_id, o.status, s.name FROM orders o JOIN services s ON o.service_id = s.service_id "
+             "WHERE o.order_id = ?", lambda ctx: [(ctx['pending_order_id'],)]),
+        ],
+        'indexed': True,
+    },
+    'stars_successful_payment': {
+        'source': 'bot.stars_successful_payment',
+        'write': True,
+        'steps': [
+            ("UPDATE orders SET status = 'approved', payment_proof = ? "
+             "WHERE order_id = ? AND user_id = ? AND status IN ('pending_payment', 'pending_approval')",
+             lambda ctx: [(f"charge_{ctx['pending_order_id']}", ctx['pending_order_id'],
+                           ctx['pending_order_key'][0])]),
+            # Run by the handler only when the UPDATE changed nothing (a repeated update)
+            ("SELECT 1 FROM orders WHERE order_id = ? AND payment_proof = ?",
+             lambda ctx: [(ctx['pending_order_id'], f"charge_{ctx['pending_order_id']}")]),
+        ],
+        'indexed': True,
+    },
+    'admin_panel_all': {
+        'source': 'app.admin_panel',
+        'steps': [
+            ("SELECT users.user_id, users.username, users.first_name, users.password_hash FROM users",
+             lambda ctx: [()]),
+            ("SELECT services.service_id, services.name, services.description, services.price_usd, "
+             "services.price_btc, services.price_stars FROM services", lambda ctx: [()]),
+            ("SELECT orders.order_id, orders.user_id, orders.service_id, orders.payment_method, orders.status "
+             "FROM orders", lambda ctx: [()]),
+        ],
+    },
+    'dashboard_lazy': {
+        'source': 'app.dashboard',
+        'steps': [
+            ("SELECT users.user_id, users.username, users.first_name, users.password_hash "
+             "FROM users WHERE users.user_id = ?", one_user),
+            ("SELECT orders.order_id, orders.user_id, orders.service_id, orders.payment_method, orders.status "
+             "FROM orders WHERE orders.user_id = ? ORDER BY orders.order_id DESC", one_user),
+            ("SELECT services.service_id, services.name, services.description, services.price_usd, "
+             "services.price_btc, services.price_stars FROM services WHERE services.service_id = ?",
+             dashboard_services),
+        ],
+        'indexed': True,
+    },
+}
+
+
+# --- Measurement ---
+def make_context(conn, orders):
+    users = max(1, orders // ORDERS_PER_USER)
+    user_id = users // 2 + 1
+    user_service_ids = sorted({row[0] for row in conn.execute(
+        "SELECT service_id FROM orders WHERE user_id = ?", (user_id,))})
+    pending_order_id, *pending_order_key = conn.execute(
+        "SELECT order_id, user_id, service_id, payment_method FROM orders "
+        "WHERE status = 'pending_payment' AND order_id >= ? ORDER BY order_id LIMIT 1",
+        (orders // 2,)
+    ).fetchone()
+    return {
+        'user_id': user_id,
+        'new_user_id': users + 1,
+        'pending_order_id': pending_order_id,
+        'pending_order_key': tuple(pending_order_key),
+        'user_service_ids': user_service_ids,
+    }
+
+
+def run_benchmark(conn, bench, ctx):
+    for sql, params, *expect_change in bench['steps']:
+        must_change = bench.get('write') and sql.lstrip().startswith(('INSERT', 'UPDATE')) \
+            and expect_change != [False]
+        for args in params(ctx):
+            cursor = conn.execute(sql, args)
+            cursor.fetchall()
+            if must_change and cursor.rowcount == 0:
+                raise RuntimeError(f"{bench['source']}: write changed no rows, the benchmark would time a no-op")
+            if expect_change == [False] and cursor.rowcount != 0:
+                raise RuntimeError(f"{bench['source']}: write expected to be ignored changed rows")
+
+
+def finish_benchmark(conn, bench):
+    # Outside the timed section; commit cost (fsync) is therefore not measured
+    if bench.get('write'):
+        conn.rollback()
+
+
+def query_plan(conn, bench, ctx):
+    plan = []
+    for sql, params, *_ in bench['steps']:
+        args = params(ctx)
+        rows = conn.execute("EXPLAIN QUERY PLAN " + sql, args[0] if args else ()).fetchall()
+        plan.append([row[3] for row in rows])
+    return plan
+
+
+def full_scans(plan):
+    """Returns plan lines that scan a whole table (not an index)."""
+    return sorted({
+        line for step in plan for line in step
+        if line.startswith('SCAN') and 'USING' not in line
+    })
+
+
+def measure(path, orders, repeat, min_time):
+    conn = sqlite3.connect(path)
+    ctx = make_context(conn, orders)
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        run_benchmark(conn, bench, ctx)  # warm up the page cache
+        finish_benchmark(conn, bench)
+        timings = []
+        deadline = time.perf_counter() + min_time
+        while len(timings) < repeat or time.perf_counter() < deadline:
+            started = time.perf_counter()
+            run_benchmark(conn, bench, ctx)
+            timings.append(time.perf_counter() - started)
+            finish_benchmark(conn, bench)
+            if len(timings) >= repeat * 100:
+                break
+        plan = query_plan(conn, bench, ctx)
+        results[name] = {
+            'source': bench['source'],
+            'indexed': bench.get('indexed', False),
+            'median': statistics.median(timings),
+            'min': min(timings),
+            'runs': len(timings),
+            'plan': plan,
+            'full_scans': full_scans(plan),
+        }
+    conn.close()
+    return results
+
+
+# --- Checks ---
+def check_indexed(results):
+    """Returns a message for every full scan in a benchmark marked 'indexed'."""
+    return [
+        f"{name} @ {size} orders: full scan in an indexed query: {', '.join(result['full_scans'])}"
+        for size, queries in results.items()
+        for name, result in queries.items()
+        if result['indexed'] and result['full_scans']
+    ]
+
+
+def compare(results, baseline, tolerance, slack):
+    """Returns a list of regression messages for results against baseline."""
+    failures = []
+    for size, queries in results.items():
+        base_queries = baseline.get(size, {})
+        for name, result in queries.items():
+            base = base_queries.get(name)
+            if base is None:
+                continue
+            limit = base['median'] * tolerance + slack
+            if result['median'] > limit:
+                failures.append(
+                    f"{name} @ {size} orders: {result['median'] * 1000:.3f} ms "
+                    f"(baseline {base['median'] * 1000:.3f} ms)"
+                )
+            new_scans = set(result['full_scans']) - set(base['full_scans'])
+            if new_scans:
+                failures.append(f"{name} @ {size} orders: new full scan {', '.join(sorted(new_scans))}")
+    return failures
+
+
+def print_results(size, results):
+    print(f"\n== {size} orders ==")
+    for name, result in results.items():
+        print(f"{name:<24} {result['median'] * 1000:>10.3f} ms  ({result['source']}, {result['runs']} runs)")
+        for step in result['plan']:
+            for line in step:
+                print(f"    {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated order counts to seed")
+    parser.add_argument('--repeat', type=int, default=5, help="minimum timed runs per query")
+    parser.add_argument('--min-time', type=float, default=0.2, help="minimum seconds spent per query")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="allowed slowdown factor against the baseline median")
+    parser.add_argument('--slack-ms', type=float, default=0.5,
+                        help="absolute slowdown always allowed, absorbs noise on fast queries")
+    args = parser.parse_args()
+
+    results = {}
+    for orders in (int(size) for size in args.sizes.split(',')):
+        results[str(orders)] = measure(get_database(orders), orders, args.repeat, args.min_time)
+        print_results(orders, results[str(orders)])
+
+    # Checked with or without a baseline, so a missing index is never saved as one
+    failures = check_indexed(results)
+    if args.save_baseline:
+        if not failures:
+            with open(args.baseline, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2, ensure_ascii=False)
+            print(f"\nBaseline saved to {args.baseline}")
+            return 0
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        failures += compare(results, baseline, args.tolerance, args.slack_ms / 1000)
+    else:
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline first.")
+
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,13 @@
 import logging
+import os
 import sqlite3
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ConversationHandler, ContextTypes
+import time
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, PreCheckoutQueryHandler, filters, CallbackQueryHandler, ConversationHandler, ContextTypes
 from telegram.helpers import escape_markdown
 import telegram.error
+from rates import RateCache, RateSnapshot, CoinGeckoRateProvider, FileRateProvider
+from idempotency import CallbackDedupCache, idempotent_callback
 
 # Настройка логирования
 logging.basicConfig(
@@ -13,9 +17,11 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Настройка базы данных ---
+DB_PATH = "rootzsu_bot.db"
+
 def setup_database():
     """Инициализирует базу данных SQLite и создает таблицы, если они не существуют."""
-    conn = sqlite3.connect("rootzsu_bot.db")
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
     # Таблица пользователей
@@ -23,9 +29,14 @@ def setup_database():
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
         username TEXT,
-        first_name TEXT
+        first_name TEXT,
+        password_hash TEXT
     )
     """)
+    # Колонка пароля для веб-панели (app.py) в базах, созданных до ее появления
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(users)")]
+    if 'password_hash' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN password_hash TEXT")
 
     # Таблица услуг (Прайс-лист)
     cursor.execute("""
@@ -48,41 +59,115 @@ def setup_database():
         payment_method TEXT,
         status TEXT DEFAULT 'pending_payment',
         payment_proof TEXT,
+        price_btc REAL,
+        btc_rate REAL,
         FOREIGN KEY (user_id) REFERENCES users (user_id),
         FOREIGN KEY (service_id) REFERENCES services (service_id)
     )
     """)
+    # Сумма в BTC и курс, названные пользователю при создании заказа, в базах, созданных до их появления
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(orders)")]
+    for column in ('price_btc', 'btc_rate'):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE orders ADD COLUMN {column} REAL")
+
+    # Не больше одного неоплаченного заказа на пользователя, услугу и способ оплаты.
+    # Старые дубликаты (от повторных нажатий) закрываются перед созданием индекса.
+    cursor.execute("""
+    UPDATE orders SET status = 'cancelled'
+    WHERE status = 'pending_payment' AND order_id NOT IN (
+        SELECT MAX(order_id) FROM orders WHERE status = 'pending_payment' GROUP BY user_id, service_id, payment_method
+    )
+    """)
+    cursor.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_open_method_unique
+    ON orders (user_id, service_id, payment_method) WHERE status = 'pending_payment'
+    """)
+    # Заказы пользователя (личный кабинет, дашборд веб-панели) без полного сканирования
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id)")
+
+    # Таблица курсов валют (последний полученный курс)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS exchange_rates (
+        currency TEXT PRIMARY KEY,
+        rate REAL NOT NULL,
+        source TEXT,
+        updated_at REAL NOT NULL
+    )
+    """)
     conn.commit()
     conn.close()
 
 def add_initial_services():
     """Добавляет начальные услуги в базу данных, если они отсутствуют."""
-    conn = sqlite3.connect("rootzsu_bot.db")
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM services")
     if cursor.fetchone()[0] == 0:
         services_data = [
-            ("Разблокировка загрузчика", "Для мобильных устройств", 15.0, 0.00015, 1000),
-            ("Установка root-прав", "Для мобильных устройств", 3.0, 0.00002478, 100),
-            ("Прошивка устройств", "Полная переустановка системы", 27.0, 0.000223, 2800),
-            ("Установка ОС (ПК)", "Windows, Linux", 11.0, 0.00009085, 1280),
-            ("Восстановление файлов", "С жестких дисков и SSD", 20.0, 0.00016518, 2200),
-            ("Реанимация флеш-накопителей", "Восстановление USB-накопителей", 25.0, 0.00042, 2050)
+            ("Разблокировка загрузчика", "Для мобильных устройств", 15.0, 1000),
+            ("Установка root-прав", "Для мобильных устройств", 3.0, 100),
+            ("Прошивка устройств", "Полная переустановка системы", 27.0, 2800),
+            ("Установка ОС (ПК)", "Windows, Linux", 11.0, 1280),
+            ("Восстановление файлов", "С жестких дисков и SSD", 20.0, 2200),
+            ("Реанимация флеш-накопителей", "Восстановление USB-накопителей", 25.0, 2050)
         ]
-        cursor.executemany("INSERT INTO services (name, description, price_usd, price_btc, price_stars) VALUES (?, ?, ?, ?, ?)", services_data)
+        # price_btc не задается вручную: он вычисляется из price_usd при обновлении курса
+        cursor.executemany("INSERT INTO services (name, description, price_usd, price_stars) VALUES (?, ?, ?, ?)", services_data)
         conn.commit()
     conn.close()
 
 # --- Конфигурация админа ---
 ADMIN_IDS = [7498691085]  # Замените на ваш реальный ID Telegram
 
+# --- Конфигурация курса BTC/USD ---
+BTC_RATE_FILE = os.getenv("BTC_RATE_FILE")  # Локальный файл с курсом вместо внешнего API (для тестов)
+BTC_RATE_REFRESH_INTERVAL = int(os.getenv("BTC_RATE_REFRESH_INTERVAL", "300"))  # Период обновления, сек
+BTC_RATE_MAX_AGE = int(os.getenv("BTC_RATE_MAX_AGE", "900"))  # Курс старше этого считается устаревшим, сек
+BTC_PRICE_DECIMALS = int(os.getenv("BTC_PRICE_DECIMALS", "8"))  # Точность округления цены в BTC
+
+rate_cache = RateCache(
+    FileRateProvider(BTC_RATE_FILE) if BTC_RATE_FILE else CoinGeckoRateProvider(),
+    max_age=BTC_RATE_MAX_AGE,
+    decimals=BTC_PRICE_DECIMALS,
+)
+
+# --- Конфигурация Bot API ---
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")  # Например, адрес локального фейкового Bot API для тестов
+
+# --- Оплата в Telegram Stars ---
+STARS_CURRENCY = "XTR"
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_REFRESH_INTERVAL", "60"))  # Период обновления кэша услуг, сек
+INVOICE_TITLE_MAX_LENGTH = 32  # Ограничения Bot API для send_invoice
+INVOICE_DESCRIPTION_MAX_LENGTH = 255
+
+# Кэш услуг: service_id -> {'name', 'description', 'price_stars'}; читается при pre_checkout_query без БД
+service_catalog = {}
+
+# --- Защита от повторных нажатий ---
+callback_dedup = CallbackDedupCache(ttl=10)
+
+# --- Ограничение состояния бесед ---
+ORDER_CONVERSATION_TIMEOUT = 15 * 60  # Брошенный процесс заказа сбрасывается через, сек (созданный заказ остается)
+PROOF_UPLOAD_TTL = 24 * 3600  # Фото чека для созданного заказа принимается в течение, сек
+ADMIN_CHAT_TIMEOUT = 30 * 60  # Неактивный чат с админом закрывается через, сек
+USER_DATA_TTL = 24 * 3600  # user_data/chat_data неактивных пользователей удаляются через, сек
+USER_DATA_MAX_ENTRIES = 10000  # Максимум записей user_data/chat_data в памяти
+STATE_SWEEP_INTERVAL = 10 * 60  # Период очистки состояния, сек
+
+ORDER_DATA_KEYS = ('service_id', 'payment_method', 'order_id', 'proof_deadline')
+
+# Время последней активности: user_id/chat_id -> time.monotonic()
+last_user_activity = {}
+last_chat_activity = {}
+
 # --- Состояния беседы ---
 SELECTING_SERVICE, SELECTING_PAYMENT, UPLOADING_PROOF, ADMIN_CHAT = range(4)
 
 # --- Вспомогательные функции ---
 def get_db_connection():
     """Устанавливает соединение с базой данных."""
-    conn = sqlite3.connect("rootzsu_bot.db")
+    conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -90,6 +175,175 @@ def is_admin(user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором."""
     return user_id in ADMIN_IDS
 
+def format_btc_price(price_usd) -> str:
+    """Возвращает цену в BTC по текущему курсу или пометку, что курс недоступен."""
+    price_btc = rate_cache.btc_price(price_usd)
+    if price_btc is None:
+        return "курс недоступен"
+    return f"{price_btc:.{BTC_PRICE_DECIMALS}f}"
+
+def clear_order_data(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Удаляет из user_data данные незавершенного заказа."""
+    for key in ORDER_DATA_KEYS:
+        context.user_data.pop(key, None)
+
+def get_rss_kb():
+    """Текущий RSS процесса в КБ (Linux), иначе пиковый RSS."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# --- Очистка состояния ---
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Запоминает время последней активности пользователя и чата (группа -1, до остальных обработчиков)."""
+    now = time.monotonic()
+    if update.effective_user:
+        last_user_activity[update.effective_user.id] = now
+    if update.effective_chat:
+        last_chat_activity[update.effective_chat.id] = now
+
+def sweep_store(store, last_activity, drop, now: float) -> int:
+    """Удаляет записи старше USER_DATA_TTL и самые старые сверх USER_DATA_MAX_ENTRIES."""
+    keys = list(store)
+    # Записи без отметки активности (созданы до запуска бота) считаем самыми старыми
+    keys.sort(key=lambda key: last_activity.get(key, 0))
+    excess = len(keys) - USER_DATA_MAX_ENTRIES
+    dropped = 0
+    for index, key in enumerate(keys):
+        idle = now - last_activity.get(key, 0)
+        if index < excess or idle > USER_DATA_TTL:
+            drop(key)
+            last_activity.pop(key, None)
+            dropped += 1
+        else:
+            break
+    # Отметки активности без данных тоже не должны копиться
+    for key in [key for key, seen in last_activity.items() if now - seen > USER_DATA_TTL]:
+        del last_activity[key]
+    return dropped
+
+def sweep_conversations(handler: ConversationHandler, now: float) -> int:
+    """Удаляет состояние беседы пользователей, неактивных дольше USER_DATA_TTL.
+
+    У PTB нет публичного API для этого, поэтому используется handler._conversations
+    (ключ — (chat_id, user_id)). Беседа создается заново через точки входа.
+    """
+    conversations = handler._conversations
+    stale = [
+        key for key in conversations
+        if key[-1] not in last_user_activity or now - last_user_activity[key[-1]] > USER_DATA_TTL
+    ]
+    for key in stale:
+        del conversations[key]
+    return len(stale)
+
+def expire_proof_markers(user_data, now: float) -> int:
+    """Удаляет метки заказов, для которых истек срок приема фото чека."""
+    expired = 0
+    for data in user_data.values():
+        if data.get('proof_deadline', now) < now:
+            for key in ORDER_DATA_KEYS:
+                data.pop(key, None)
+            expired += 1
+    return expired
+
+async def sweep_conversation_state(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая задача JobQueue: удаляет user_data/chat_data и состояние главной беседы
+    неактивных пользователей, просроченные метки заказов и логирует память.
+
+    context.job.data — главный ConversationHandler.
+    """
+    application = context.application
+    now = time.monotonic()
+    dropped_conversations = sweep_conversations(context.job.data, now)
+    dropped_users = sweep_store(application.user_data, last_user_activity, application.drop_user_data, now)
+    dropped_chats = sweep_store(application.chat_data, last_chat_activity, application.drop_chat_data, now)
+    expired_orders = expire_proof_markers(application.user_data, now)
+    logger.info(
+        f"Очистка состояния: удалено бесед={dropped_conversations}, user_data={dropped_users}, "
+        f"chat_data={dropped_chats}, меток заказов={expired_orders}; "
+        f"осталось бесед={len(context.job.data._conversations)}, "
+        f"user_data={len(application.user_data)}, chat_data={len(application.chat_data)}, "
+        f"кэш callback={len(callback_dedup)}; RSS={get_rss_kb()} КБ"
+    )
+
+# --- Кэш услуг ---
+def load_service_catalog() -> None:
+    """Загружает услуги из базы данных в кэш service_catalog."""
+    global service_catalog
+    conn = get_db_connection()
+    services = conn.execute("SELECT service_id, name, description, price_stars FROM services").fetchall()
+    conn.close()
+    service_catalog = {
+        s['service_id']: {'name': s['name'], 'description': s['description'], 'price_stars': s['price_stars']}
+        for s in services
+    }
+
+async def refresh_service_catalog(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая задача JobQueue: подхватывает изменения цен из веб-панели."""
+    load_service_catalog()
+
+def truncate(text: str, limit: int) -> str:
+    """Обрезает текст до limit символов, заменяя конец многоточием."""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def make_stars_payload(order_id: int, service_id: int, user_id: int) -> str:
+    return f"order:{order_id}:{service_id}:{user_id}"
+
+def parse_stars_payload(payload: str):
+    """Разбирает payload счета в (order_id, service_id, user_id) или возвращает None."""
+    try:
+        prefix, order_id, service_id, user_id = payload.split(':')
+        if prefix != 'order':
+            return None
+        return int(order_id), int(service_id), int(user_id)
+    except (ValueError, AttributeError):
+        return None
+
+def enter_menu(callback):
+    """Оборачивает обработчик кнопки меню, чтобы нажатие без активной беседы открывало главную беседу."""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        await callback(update, context)
+        return 0
+    return wrapper
+
+# --- Курс BTC/USD ---
+def load_saved_rate() -> None:
+    """Загружает последний сохраненный курс в кэш, чтобы не ждать первого обновления после перезапуска."""
+    conn = get_db_connection()
+    row = conn.execute("SELECT rate, source, updated_at FROM exchange_rates WHERE currency = 'BTC'").fetchone()
+    conn.close()
+    if row:
+        rate_cache.set_snapshot(RateSnapshot(row['rate'], row['updated_at'], row['source']))
+
+def save_rate(snapshot: RateSnapshot) -> None:
+    """Сохраняет курс и пересчитывает price_btc для всех услуг."""
+    conn = get_db_connection()
+    conn.execute(
+        "INSERT OR REPLACE INTO exchange_rates (currency, rate, source, updated_at) VALUES ('BTC', ?, ?, ?)",
+        (snapshot.rate, snapshot.source, snapshot.fetched_at)
+    )
+    services = conn.execute("SELECT service_id, price_usd FROM services").fetchall()
+    conn.executemany(
+        "UPDATE services SET price_btc = ? WHERE service_id = ?",
+        [(rate_cache.btc_price(s['price_usd']), s['service_id']) for s in services]
+    )
+    conn.commit()
+    conn.close()
+
+async def refresh_btc_rate(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая задача JobQueue: обновляет курс BTC/USD в кэше и в базе данных."""
+    snapshot = await rate_cache.refresh()
+    if snapshot is None:
+        if not rate_cache.is_fresh():
+            logger.warning("Курс BTC/USD устарел, оплата в BTC временно недоступна.")
+        return
+    save_rate(snapshot)
+    logger.info(f"Курс BTC/USD обновлен: {snapshot.rate} ({snapshot.source})")
+
 # --- Обработчики команд пользователя ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обрабатывает команду /start и показывает главное меню."""
@@ -148,7 +402,7 @@ async def price_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         message_text += (
             f"🔹 *{safe_name}*\n"
             f"   _{safe_desc}_\n"
-            f"   *Цена:* ${service['price_usd']} | {service['price_btc']} BTC | {service['price_stars']} ⭐\n\n"
+            f"   *Цена:* ${service['price_usd']} | {format_btc_price(service['price_usd'])} BTC | {service['price_stars']} ⭐\n\n"
         )
 
     keyboard = [[InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu")]]
@@ -160,6 +414,8 @@ async def order_service_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Начинает процесс создания заказа, показывая услуги."""
     query = update.callback_query
     await query.answer()
+    # Новый процесс заменяет метку предыдущего заказа; открытый заказ переиспользуется при повторном выборе
+    clear_order_data(context)
 
     conn = get_db_connection()
     services = conn.execute("SELECT service_id, name FROM services").fetchall()
@@ -189,9 +445,12 @@ async def select_payment_method(update: Update, context: ContextTypes.DEFAULT_TY
     
     safe_name = escape_markdown(service['name'])
     text = f"Вы выбрали: *{safe_name}*\n\nВыберите способ оплаты:"
-    keyboard = [
-        [InlineKeyboardButton(f"💵 USD (${service['price_usd']})", callback_data=f"pay_usd_{service_id}")],
-        [InlineKeyboardButton(f"🪙 BTC ({service['price_btc']})", callback_data=f"pay_btc_{service_id}")],
+    keyboard = [[InlineKeyboardButton(f"💵 USD (${service['price_usd']})", callback_data=f"pay_usd_{service_id}")]]
+    # Оплата в BTC предлагается только при актуальном курсе
+    price_btc = rate_cache.btc_price(service['price_usd'])
+    if price_btc is not None:
+        keyboard.append([InlineKeyboardButton(f"🪙 BTC ({price_btc:.{BTC_PRICE_DECIMALS}f})", callback_data=f"pay_btc_{service_id}")])
+    keyboard += [
         [InlineKeyboardButton(f"⭐ Stars ({service['price_stars']})", callback_data=f"pay_stars_{service_id}")],
         [InlineKeyboardButton("⬅️ Назад к услугам", callback_data="order_service")],
     ]
@@ -199,6 +458,7 @@ async def select_payment_method(update: Update, context: ContextTypes.DEFAULT_TY
     await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode='Markdown')
     return SELECTING_PAYMENT
 
+@idempotent_callback(callback_dedup)
 async def process_payment_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обрабатывает выбор способа оплаты и запрашивает подтверждение оплаты."""
     query = update.callback_query
@@ -206,24 +466,76 @@ async def process_payment_selection(update: Update, context: ContextTypes.DEFAUL
     payment_method = parts[1].upper()
     service_id = int(parts[2])
 
+    # Сумма в BTC фиксируется в заказе: курс обновляется, а админу нужно с чем сверить оплату
+    quote_btc = quote_rate = None
+    if payment_method == 'BTC':
+        conn = get_db_connection()
+        service_row = conn.execute("SELECT price_usd FROM services WHERE service_id = ?", (service_id,)).fetchone()
+        conn.close()
+        snapshot = rate_cache.snapshot
+        quote_btc = rate_cache.btc_price(service_row['price_usd']) if service_row else None
+        if quote_btc is None:
+            await query.answer("Курс BTC временно недоступен. Выберите другой способ оплаты.", show_alert=True)
+            return SELECTING_PAYMENT
+        quote_rate = snapshot.rate
+
+    service = service_catalog.get(service_id)
+    if payment_method == 'STARS' and (not service or not service['price_stars'] or service['price_stars'] < 1):
+        await query.answer("Оплата Stars для этой услуги недоступна. Выберите другой способ оплаты.", show_alert=True)
+        return SELECTING_PAYMENT
+
     context.user_data['payment_method'] = payment_method
     await query.answer()
 
-    # Создаем заказ в базе данных
+    # Создаем заказ в базе данных или переиспользуем уже открытый заказ на эту услугу и способ оплаты
     user_id = query.from_user.id
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO orders (user_id, service_id, payment_method) VALUES (?, ?, ?)",
-                   (user_id, service_id, payment_method))
-    order_id = cursor.lastrowid
+    cursor.execute(
+        "INSERT OR IGNORE INTO orders (user_id, service_id, payment_method, price_btc, btc_rate) VALUES (?, ?, ?, ?, ?)",
+        (user_id, service_id, payment_method, quote_btc, quote_rate)
+    )
+    if cursor.rowcount:
+        order_id = cursor.lastrowid
+    else:
+        order_id = cursor.execute(
+            "SELECT order_id FROM orders WHERE user_id = ? AND service_id = ? AND payment_method = ? "
+            "AND status = 'pending_payment'",
+            (user_id, service_id, payment_method)
+        ).fetchone()['order_id']
+        if payment_method == 'BTC':
+            # Повторный выбор BTC для открытого заказа: сумма пересчитывается по текущему курсу
+            cursor.execute("UPDATE orders SET price_btc = ?, btc_rate = ? WHERE order_id = ?",
+                           (quote_btc, quote_rate, order_id))
     conn.commit()
     conn.close()
     context.user_data['order_id'] = order_id
+    context.user_data['proof_deadline'] = time.monotonic() + PROOF_UPLOAD_TTL
+
+    if payment_method == 'STARS':
+        # Оплата Stars подтверждается самим Telegram, скриншот не нужен
+        await query.edit_message_text(
+            text=f"Ваш заказ `#{order_id}` создан.\n\nОплатите счет ниже — заказ будет одобрен автоматически.",
+            parse_mode='Markdown'
+        )
+        await context.bot.send_invoice(
+            chat_id=query.message.chat_id,
+            title=truncate(service['name'], INVOICE_TITLE_MAX_LENGTH),
+            description=truncate(service['description'] or service['name'], INVOICE_DESCRIPTION_MAX_LENGTH),
+            payload=make_stars_payload(order_id, service_id, user_id),
+            provider_token="",
+            currency=STARS_CURRENCY,
+            prices=[LabeledPrice(service['name'], service['price_stars'])],
+        )
+        clear_order_data(context)
+        return ConversationHandler.END
 
     payment_details = {
         'USD': "Пожалуйста, переведите оплату на `UQCKtm0RoDtPCyObq18G-FKehsDPaVIiVX5Z8q78P_XfmTUh`.",
-        'BTC': "Пожалуйста, переведите оплату на `UQCKtm0RoDtPCyObq18G-FKehsDPaVIiVX5Z8q78P_XfmTUh`.",
-        'STARS': "Пожалуйста, используйте встроенную функцию Telegram для отправки Stars."
+        'BTC': (
+            f"Пожалуйста, переведите *{quote_btc:.{BTC_PRICE_DECIMALS}f} BTC* "
+            "на `UQCKtm0RoDtPCyObq18G-FKehsDPaVIiVX5Z8q78P_XfmTUh`."
+        ) if quote_btc is not None else None,
     }
 
     text = (
@@ -239,18 +551,24 @@ async def upload_proof(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     photo = update.message.photo[-1]  # Берем фото с самым высоким разрешением
     file_id = photo.file_id
     order_id = context.user_data.get('order_id')
-
     if not order_id:
         await update.message.reply_text("Произошла ошибка. Пожалуйста, начните процесс заказа заново.")
         return ConversationHandler.END
 
-    # Обновляем заказ с подтверждением и меняем статус
+    # Обновляем заказ с подтверждением и меняем статус (только для неоплаченного заказа)
     conn = get_db_connection()
-    conn.execute("UPDATE orders SET payment_proof = ?, status = 'pending_approval' WHERE order_id = ?",
-                 (file_id, order_id))
+    cursor = conn.execute(
+        "UPDATE orders SET payment_proof = ?, status = 'pending_approval' WHERE order_id = ? AND status = 'pending_payment'",
+        (file_id, order_id)
+    )
     conn.commit()
+    if cursor.rowcount == 0:
+        conn.close()
+        await update.message.reply_text("Подтверждение для этого заказа уже получено.")
+        return ConversationHandler.END
     service = conn.execute(
-        "SELECT s.name FROM services s JOIN orders o ON s.service_id = o.service_id WHERE o.order_id = ?",
+        "SELECT s.name, o.payment_method, o.price_btc, o.btc_rate FROM services s "
+        "JOIN orders o ON s.service_id = o.service_id WHERE o.order_id = ?",
         (order_id,)
     ).fetchone()
     conn.close()
@@ -268,6 +586,11 @@ async def upload_proof(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         f"Пользователь: {update.effective_user.mention_markdown_v2()}\n"
         f"Услуга: *{safe_service_name}*"
     )
+    if service['payment_method'] == 'BTC' and service['price_btc'] is not None:
+        quote = escape_markdown(
+            f"{service['price_btc']:.{BTC_PRICE_DECIMALS}f} BTC (курс {service['btc_rate']:.2f} USD)", version=2
+        )
+        admin_text += f"\nСумма к оплате: *{quote}*"
     keyboard = [[
         InlineKeyboardButton("✅ Одобрить", callback_data=f"admin_approve_{order_id}"),
         InlineKeyboardButton("❌ Отклонить", callback_data=f"admin_decline_{order_id}")
@@ -287,17 +610,134 @@ async def upload_proof(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         except telegram.error.BadRequest as e:
             logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
 
+    clear_order_data(context)
     return ConversationHandler.END
 
+async def upload_late_proof(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Принимает фото чека, присланное после таймаута процесса заказа.
+
+    Заказ берется только из метки в user_data; без метки или после PROOF_UPLOAD_TTL фото игнорируется.
+    """
+    if context.user_data.get('proof_deadline', 0) < time.monotonic():
+        clear_order_data(context)
+        return None
+    await upload_proof(update, context)
+    return None
+
 async def cancel_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отменяет процесс создания заказа."""
     query = update.callback_query
     await query.answer()
     await query.edit_message_text("Заказ отменен.")
     context.user_data.clear()
+    callback_dedup.forget_user(query.from_user.id)
     await start(update, context)
     return ConversationHandler.END
 
+async def stars_pre_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Проверяет счет Stars перед списанием. Использует только кэш услуг, без обращения к БД."""
+    query = update.pre_checkout_query
+    parsed = parse_stars_payload(query.invoice_payload)
+    if parsed is None:
+        await query.answer(ok=False, error_message="Неизвестный счет. Оформите заказ заново.")
+        return
+
+    order_id, service_id, user_id = parsed
+    service = service_catalog.get(service_id)
+    if query.from_user.id != user_id or query.currency != STARS_CURRENCY or service is None:
+        await query.answer(ok=False, error_message="Счет недействителен. Оформите заказ заново.")
+        return
+    if query.total_amount != service['price_stars']:
+        await query.answer(ok=False, error_message="Цена услуги изменилась. Оформите заказ заново.")
+        return
+
+    await query.answer(ok=True)
+
+async def stars_successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Одобряет заказ после успешной оплаты Stars и уведомляет пользователя и админов."""
+    payment = update.message.successful_payment
+    parsed = parse_stars_payload(payment.invoice_payload)
+    if parsed is None:
+        logger.error(f"Оплата Stars с неизвестным payload: {payment.invoice_payload}")
+        return
+
+    order_id, service_id, user_id = parsed
+    # В payment_proof сохраняется ID платежа Telegram (нужен для возврата)
+    conn = get_db_connection()
+    cursor = conn.execute(
+        "UPDATE orders SET status = 'approved', payment_proof = ? "
+        "WHERE order_id = ? AND user_id = ? AND status IN ('pending_payment', 'pending_approval')",
+        (payment.telegram_payment_charge_id, order_id, user_id)
+    )
+    conn.commit()
+    updated = cursor.rowcount > 0
+    already_recorded = not updated and conn.execute(
+        "SELECT 1 FROM orders WHERE order_id = ? AND payment_proof = ?",
+        (order_id, payment.telegram_payment_charge_id)
+    ).fetchone() is not None
+    conn.close()
+    if already_recorded:
+        logger.info(f"Повторное уведомление об оплате Stars для заказа #{order_id} пропущено")
+        return
+    if not updated:
+        # Заказ уже закрыт (например, отклонен): деньги списаны, нужен ручной возврат
+        logger.warning(f"Оплата Stars для закрытого заказа #{order_id}")
+        await update.message.reply_text(
+            f"Оплата по заказу #{order_id} получена, но заказ уже закрыт. "
+            "Администратор свяжется с вами для возврата средств."
+        )
+        for admin_id in ADMIN_IDS:
+            try:
+                await context.bot.send_message(
+                    chat_id=admin_id,
+                    text=f"⚠️ Оплата Stars по закрытому заказу #{order_id} от пользователя {user_id}. "
+                         f"Требуется возврат, ID платежа: {payment.telegram_payment_charge_id}"
+                )
+            except telegram.error.BadRequest as e:
+                logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+        return
+
+    service = service_catalog.get(service_id)
+    service_name = escape_markdown(service['name'] if service else f"#{service_id}", version=2)
+    await update.message.reply_text(
+        f"✅ Оплата получена\\! Ваш заказ `#{order_id}` на услугу *{service_name}* *одобрен*\\. "
+        "Администратор скоро свяжется с вами для уточнения деталей\\.",
+        parse_mode='MarkdownV2'
+    )
+
+    admin_text = (
+        f"⭐ *Оплата Stars получена*\n\n"
+        f"Заказ: `#{order_id}` \\(одобрен автоматически\\)\n"
+        f"Пользователь: {update.effective_user.mention_markdown_v2()}\n"
+        f"Услуга: *{service_name}*\n"
+        f"Сумма: {payment.total_amount} ⭐"
+    )
+    for admin_id in ADMIN_IDS:
+        try:
+            await context.bot.send_message(chat_id=admin_id, text=admin_text, parse_mode='MarkdownV2')
+        except telegram.error.BadRequest as e:
+            logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+
+async def order_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сбрасывает брошенный процесс заказа по истечении ORDER_CONVERSATION_TIMEOUT.
+
+    Если заказ уже создан, в user_data остаются order_id и proof_deadline:
+    фото чека примет upload_late_proof, пока метку не удалит sweep_conversation_state.
+    """
+    if 'order_id' in context.user_data:
+        context.user_data.pop('service_id', None)
+        context.user_data.pop('payment_method', None)
+        return
+    clear_order_data(context)
+    if update.effective_chat:
+        try:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="⌛ Время оформления заказа истекло. Чтобы начать заново, нажмите «🛒 Заказать услугу» или отправьте /start."
+            )
+        except telegram.error.TelegramError as e:
+            logger.error(f"Не удалось уведомить о таймауте заказа: {e}")
+
 # --- Личный кабинет и админ-панель ---
 async def my_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает информацию о пользователе и историю заказов."""
@@ -318,7 +758,8 @@ async def my_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         'pending_payment': 'Ожидает оплаты',
         'pending_approval': 'На проверке',
         'approved': 'Одобрен',
-        'declined': 'Отклонен'
+        'declined': 'Отклонен',
+        'cancelled': 'Отменен'
     }
 
     if not orders:
@@ -406,31 +847,43 @@ async def admin_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(text=message_text, reply_markup=reply_markup, parse_mode='Markdown')
 
+@idempotent_callback(callback_dedup)
 async def admin_handle_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает решение админа по заказу (одобрить/отклонить)."""
     query = update.callback_query
     action, order_id_str = query.data.split('_')[1:]
     order_id = int(order_id_str)
-    await query.answer(f"Заказ #{order_id} был обработан.")
 
     new_status = 'approved' if action == 'approve' else 'declined'
     
+    # Статус меняется только у необработанного заказа, повторное решение ничего не делает
     conn = get_db_connection()
-    conn.execute("UPDATE orders SET status = ? WHERE order_id = ?", (new_status, order_id))
+    cursor = conn.execute(
+        "UPDATE orders SET status = ? WHERE order_id = ? AND status IN ('pending_payment', 'pending_approval')",
+        (new_status, order_id)
+    )
     conn.commit()
+    updated = cursor.rowcount > 0
     order_info = conn.execute(
-        "SELECT user_id, s.name FROM orders o JOIN services s ON o.service_id = s.service_id WHERE o.order_id = ?", 
+        "SELECT user_id, o.status, s.name FROM orders o JOIN services s ON o.service_id = s.service_id WHERE o.order_id = ?", 
         (order_id,)
     ).fetchone()
     conn.close()
 
     if not order_info:
+        await query.answer()
         await query.edit_message_caption(
             caption=f"{query.message.caption}\n\n--- ОШИБКА: Заказ #{order_id} не найден в базе данных. ---", 
             reply_markup=None
         )
         return
 
+    if not updated:
+        await query.answer(f"Заказ #{order_id} уже обработан (статус: {order_info['status']}).", show_alert=True)
+        return
+
+    await query.answer(f"Заказ #{order_id} был обработан.")
+
     user_id = order_info['user_id']
     service_name = escape_markdown(order_info['name'], version=2)
     
@@ -533,12 +986,31 @@ async def cancel_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     await start(update, context)
     return ConversationHandler.END
 
+async def admin_chat_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Закрывает неактивный чат с админом по истечении ADMIN_CHAT_TIMEOUT."""
+    if update.effective_chat:
+        try:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="⌛ Чат с администратором закрыт из-за неактивности. Отправьте /start, чтобы открыть меню."
+            )
+        except telegram.error.TelegramError as e:
+            logger.error(f"Не удалось уведомить о закрытии чата: {e}")
+
 def main() -> None:
     """Запускает бота."""
-    application = Application.builder().token("8243984344:AAH3SFyuy4I_O62Ml8KcxCgyZTQ4ZVYKep0").build()
+    builder = Application.builder().token("8243984344:AAH3SFyuy4I_O62Ml8KcxCgyZTQ4ZVYKep0")
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(f"{BOT_API_BASE_URL}/bot").base_file_url(f"{BOT_API_BASE_URL}/file/bot")
+    application = builder.build()
 
     setup_database()
     add_initial_services()
+    load_saved_rate()
+    load_service_catalog()
+    application.job_queue.run_repeating(refresh_service_catalog, interval=CATALOG_REFRESH_INTERVAL, first=CATALOG_REFRESH_INTERVAL)
+    # Курс обновляется в фоне; обработчики читают только снимок из памяти
+    application.job_queue.run_repeating(refresh_btc_rate, interval=BTC_RATE_REFRESH_INTERVAL, first=0)
     # Обработчик процесса заказа
     order_conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(order_service_start, pattern='^order_service$')],
@@ -546,12 +1018,14 @@ def main() -> None:
             SELECTING_SERVICE: [CallbackQueryHandler(select_payment_method, pattern='^select_service_')],
             SELECTING_PAYMENT: [CallbackQueryHandler(process_payment_selection, pattern='^pay_')],
             UPLOADING_PROOF: [MessageHandler(filters.PHOTO, upload_proof)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, order_timeout)],
         },
         fallbacks=[
             CallbackQueryHandler(cancel_order, pattern='^cancel_order$'),
             CallbackQueryHandler(order_service_start, pattern='^order_service$')
         ],
         map_to_parent={ConversationHandler.END: 0},
+        conversation_timeout=ORDER_CONVERSATION_TIMEOUT,
         per_message=False
     )
     
@@ -559,34 +1033,57 @@ def main() -> None:
     admin_chat_conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(contact_admin_start, pattern='^contact_admin$')],
         states={
-            ADMIN_CHAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, forward_to_admin)]
+            ADMIN_CHAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, forward_to_admin)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, admin_chat_timeout)],
         },
         fallbacks=[CommandHandler('cancel', cancel_chat)],
         map_to_parent={ConversationHandler.END: 0},
+        conversation_timeout=ADMIN_CHAT_TIMEOUT,
         per_message=False
     )
 
     # Главный обработчик
+    menu_callbacks = [
+        ('^main_menu$', start),
+        ('^price_list$', price_list),
+        ('^my_account$', my_account),
+        ('^admin_panel$', admin_panel),
+        ('^admin_view_users$', admin_view_users),
+        ('^admin_view_orders$', admin_view_orders),
+        ('^admin_(approve|decline)_', admin_handle_order),
+    ]
+
+    # Кнопки меню работают и без активной беседы (например, после перезапуска бота):
+    # они же служат точками входа, а любая другая кнопка из старого сообщения показывает меню
+    # (иначе нажатие осталось бы без ответа).
+    # У главного обработчика нет conversation_timeout: PTB не поддерживает его вместе с
+    # вложенными беседами. Таймауты заданы у вложенных бесед, а номер состояния
+    # неактивных пользователей удаляет sweep_conversation_state.
     main_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[CommandHandler("start", start)]
+        + [CallbackQueryHandler(enter_menu(callback), pattern=pattern) for pattern, callback in menu_callbacks]
+        + [CallbackQueryHandler(start)],
         states={
-            0: [
-                CallbackQueryHandler(start, pattern='^main_menu$'),
-                CallbackQueryHandler(price_list, pattern='^price_list$'),
-                CallbackQueryHandler(my_account, pattern='^my_account$'),
-                CallbackQueryHandler(admin_panel, pattern='^admin_panel$'),
-                CallbackQueryHandler(admin_view_users, pattern='^admin_view_users$'),
-                CallbackQueryHandler(admin_view_orders, pattern='^admin_view_orders$'),
-                CallbackQueryHandler(admin_handle_order, pattern='^admin_(approve|decline)_'),
+            0: [CallbackQueryHandler(callback, pattern=pattern) for pattern, callback in menu_callbacks] + [
                 order_conv_handler,
                 admin_chat_conv_handler,
+                CallbackQueryHandler(start),
+                # Фото чека, присланное после таймаута процесса заказа
+                MessageHandler(filters.PHOTO, upload_late_proof),
             ]
         },
         fallbacks=[CommandHandler("start", start)],
         per_message=False
     )
+    # Периодическая очистка состояния неактивных пользователей
+    application.job_queue.run_repeating(
+        sweep_conversation_state, interval=STATE_SWEEP_INTERVAL, first=STATE_SWEEP_INTERVAL, data=main_handler
+    )
 
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
     application.add_handler(main_handler)
+    application.add_handler(PreCheckoutQueryHandler(stars_pre_checkout))
+    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, stars_successful_payment))
     application.add_handler(MessageHandler(filters.REPLY & filters.User(user_id=ADMIN_IDS), reply_to_user))
 
     application.run_polling()
@@ -0,0 +1,88 @@
+import functools
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_IN_FLIGHT = object()
+
+
+class CallbackDedupCache:
+    """Кратковременный кэш результатов обработчиков callback-кнопок.
+
+    Ключ — (user_id, callback_data, message_id). Повторное нажатие той же кнопки
+    в течение ttl секунд (двойной тап, повтор запроса Telegram) получает
+    сохраненный результат без повторного выполнения обработчика.
+    """
+
+    def __init__(self, ttl: float = 10, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(query):
+        message_id = query.message.message_id if query.message else query.inline_message_id
+        return (query.from_user.id, query.data, message_id)
+
+    def _evict(self, now: float) -> None:
+        # Записи упорядочены по времени добавления, поэтому устаревшие всегда в начале
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_size:
+                break
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        """Возвращает (найдено, результат). Для выполняющегося обработчика результат — _IN_FLIGHT."""
+        now = time.monotonic()
+        self._evict(now)
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        return True, entry[1]
+
+    def set(self, key, result) -> None:
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._evict(time.monotonic())
+
+    def discard(self, key) -> None:
+        self._entries.pop(key, None)
+
+    def forget_user(self, user_id: int) -> None:
+        """Удаляет все записи пользователя, например после отмены заказа."""
+        for key in [key for key in self._entries if key[0] == user_id]:
+            del self._entries[key]
+
+
+def idempotent_callback(cache: CallbackDedupCache):
+    """Декоратор для обработчиков CallbackQuery: повторные нажатия отвечаются из кэша, без обращения к БД."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            query = update.callback_query
+            key = cache.make_key(query)
+            found, result = cache.get(key)
+            if found:
+                logger.info(f"Повторный callback {query.data} от {query.from_user.id} обработан из кэша")
+                if result is _IN_FLIGHT:
+                    await query.answer("⏳ Запрос уже обрабатывается...")
+                    return None
+                await query.answer()
+                return result
+
+            cache.set(key, _IN_FLIGHT)
+            try:
+                result = await handler(update, context)
+            except Exception:
+                cache.discard(key)
+                raise
+            cache.set(key, result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,116 @@
+import abc
+import asyncio
+import json
+import logging
+import math
+import time
+import urllib.request
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+logger = logging.getLogger(__name__)
+
+# Снимок курса: сколько USD стоит 1 BTC, когда и откуда он получен
+RateSnapshot = namedtuple("RateSnapshot", ["rate", "fetched_at", "source"])
+
+
+def convert_usd_to_btc(price_usd, rate, decimals: int = 8, rounding: str = ROUND_HALF_UP) -> float:
+    """Переводит цену в USD в BTC по курсу rate с округлением до decimals знаков."""
+    quantum = Decimal(1).scaleb(-decimals)
+    value = Decimal(str(price_usd)) / Decimal(str(rate))
+    return float(value.quantize(quantum, rounding=rounding))
+
+
+# --- Поставщики курса ---
+class RateProvider(abc.ABC):
+    """Базовый поставщик курса BTC/USD. fetch() блокирующий и вызывается вне event loop."""
+    name = "base"
+
+    @abc.abstractmethod
+    def fetch(self) -> float:
+        ...
+
+
+class CoinGeckoRateProvider(RateProvider):
+    """Получает курс BTC/USD из публичного API CoinGecko."""
+    name = "coingecko"
+    URL = "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=usd"
+
+    def __init__(self, timeout: float = 10.0):
+        self.timeout = timeout
+
+    def fetch(self) -> float:
+        with urllib.request.urlopen(self.URL, timeout=self.timeout) as response:
+            data = json.load(response)
+        return float(data["bitcoin"]["usd"])
+
+
+class FileRateProvider(RateProvider):
+    """Читает курс из локального файла: число или JSON вида {"usd": 65000}. Для тестов и офлайн-работы."""
+    name = "file"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self) -> float:
+        with open(self.path, encoding="utf-8") as f:
+            raw = f.read().strip()
+        if raw.startswith("{"):
+            return float(json.loads(raw)["usd"])
+        return float(raw)
+
+
+# --- Кэш курса ---
+class RateCache:
+    """Хранит последний снимок курса в памяти.
+
+    Обработчики только читают снимок и никогда не ждут I/O; обновление выполняет
+    фоновая задача через refresh().
+    """
+
+    def __init__(self, provider: RateProvider, max_age: float = 900, decimals: int = 8, rounding: str = ROUND_HALF_UP):
+        self.provider = provider
+        self.max_age = max_age
+        self.decimals = decimals
+        self.rounding = rounding
+        self._snapshot = None
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def set_snapshot(self, snapshot: RateSnapshot) -> None:
+        self._snapshot = snapshot
+
+    def age(self):
+        """Возраст снимка в секундах или None, если курса нет."""
+        if self._snapshot is None:
+            return None
+        return time.time() - self._snapshot.fetched_at
+
+    def is_fresh(self) -> bool:
+        age = self.age()
+        return age is not None and age <= self.max_age
+
+    def btc_price(self, price_usd):
+        """Переводит цену в USD в BTC по текущему курсу. Возвращает None, если курс устарел."""
+        if price_usd is None or not self.is_fresh():
+            return None
+        return convert_usd_to_btc(price_usd, self._snapshot.rate, self.decimals, self.rounding)
+
+    async def refresh(self):
+        """Запрашивает курс у поставщика в отдельном потоке и обновляет снимок.
+
+        При ошибке сохраняет предыдущий снимок и возвращает None.
+        """
+        try:
+            rate = await asyncio.to_thread(self.provider.fetch)
+        except Exception as e:
+            logger.error(f"Не удалось обновить курс BTC/USD ({self.provider.name}): {e}")
+            return None
+        if not math.isfinite(rate) or rate <= 0:
+            logger.error(f"Поставщик {self.provider.name} вернул некорректный курс: {rate}")
+            return None
+        snapshot = RateSnapshot(rate, time.time(), self.provider.name)
+        self._snapshot = snapshot
+        return snapshot
@@ -0,0 +1,121 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import idempotency
+from idempotency import CallbackDedupCache, idempotent_callback
+
+
+class FakeQuery:
+    def __init__(self, user_id=1, data="pay_BTC", message_id=100):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = SimpleNamespace(message_id=message_id)
+        self.inline_message_id = None
+        self.answers = []
+
+    async def answer(self, text=None):
+        self.answers.append(text)
+
+
+def make_update(query):
+    return SimpleNamespace(callback_query=query)
+
+
+def counting_handler(cache, result=1):
+    calls = []
+
+    @idempotent_callback(cache)
+    async def handler(update, context):
+        calls.append(update)
+        return result
+    return handler, calls
+
+
+def test_duplicate_returns_cached_result():
+    cache = CallbackDedupCache()
+    handler, calls = counting_handler(cache, result=2)
+    query = FakeQuery()
+    assert asyncio.run(handler(make_update(query), None)) == 2
+    assert asyncio.run(handler(make_update(query), None)) == 2
+    assert len(calls) == 1
+    assert query.answers == [None]
+
+
+def test_other_message_is_not_a_duplicate():
+    cache = CallbackDedupCache()
+    handler, calls = counting_handler(cache)
+    asyncio.run(handler(make_update(FakeQuery(message_id=100)), None))
+    asyncio.run(handler(make_update(FakeQuery(message_id=101)), None))
+    assert len(calls) == 2
+
+
+def test_in_flight_duplicate_is_answered_and_dropped():
+    cache = CallbackDedupCache()
+    calls = []
+
+    @idempotent_callback(cache)
+    async def handler(update, context):
+        calls.append(update)
+        await asyncio.sleep(0.01)
+        return 1
+
+    async def run_both():
+        first, second = FakeQuery(), FakeQuery()
+        results = await asyncio.gather(handler(make_update(first), None), handler(make_update(second), None))
+        return results, second
+
+    results, second = asyncio.run(run_both())
+    assert results == [1, None]
+    assert len(calls) == 1
+    assert second.answers == ["⏳ Запрос уже обрабатывается..."]
+
+
+def test_exception_allows_retry():
+    cache = CallbackDedupCache()
+    calls = []
+
+    @idempotent_callback(cache)
+    async def handler(update, context):
+        calls.append(update)
+        if len(calls) == 1:
+            raise RuntimeError("db locked")
+        return 3
+
+    query = FakeQuery()
+    with pytest.raises(RuntimeError):
+        asyncio.run(handler(make_update(query), None))
+    assert asyncio.run(handler(make_update(query), None)) == 3
+    assert len(calls) == 2
+
+
+def test_forget_user_drops_only_that_user():
+    cache = CallbackDedupCache()
+    cache.set((1, "a", 100), 1)
+    cache.set((1, "b", 100), 1)
+    cache.set((2, "a", 100), 1)
+    cache.forget_user(1)
+    assert len(cache) == 1
+    assert cache.get((2, "a", 100)) == (True, 1)
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(idempotency.time, "monotonic", lambda: now[0])
+    cache = CallbackDedupCache(ttl=10)
+    cache.set("key", 1)
+    now[0] += 9
+    assert cache.get("key") == (True, 1)
+    now[0] += 2
+    assert cache.get("key") == (False, None)
+    assert len(cache) == 0
+
+
+def test_max_size_evicts_oldest():
+    cache = CallbackDedupCache(max_size=2)
+    for key in ("a", "b", "c"):
+        cache.set(key, key)
+    assert len(cache) == 2
+    assert cache.get("a") == (False, None)
+    assert cache.get("c") == (True, "c")
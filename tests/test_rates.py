@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+import pytest
+
+from rates import FileRateProvider, RateCache, RateSnapshot, convert_usd_to_btc
+
+
+def write_rate(tmp_path, text):
+    path = tmp_path / "rate.txt"
+    path.write_text(text, encoding="utf-8")
+    return FileRateProvider(str(path))
+
+
+def test_file_provider_reads_plain_number(tmp_path):
+    assert write_rate(tmp_path, "65000.5\n").fetch() == 65000.5
+
+
+def test_file_provider_reads_json(tmp_path):
+    assert write_rate(tmp_path, '{"usd": 50000}').fetch() == 50000.0
+
+
+def test_refresh_stores_snapshot(tmp_path):
+    cache = RateCache(write_rate(tmp_path, "50000"))
+    snapshot = asyncio.run(cache.refresh())
+    assert snapshot.rate == 50000.0
+    assert snapshot.source == "file"
+    assert cache.btc_price(15) == 0.0003
+
+
+@pytest.mark.parametrize("value", ["inf", "nan", "0", "-1"])
+def test_refresh_rejects_invalid_rate(tmp_path, value):
+    cache = RateCache(write_rate(tmp_path, value))
+    cache.set_snapshot(RateSnapshot(50000.0, time.time(), "file"))
+    assert asyncio.run(cache.refresh()) is None
+    assert cache.snapshot.rate == 50000.0
+
+
+def test_refresh_keeps_snapshot_when_provider_fails(tmp_path):
+    cache = RateCache(FileRateProvider(str(tmp_path / "missing.txt")))
+    assert asyncio.run(cache.refresh()) is None
+    assert cache.snapshot is None
+
+
+def test_stale_rate_gives_no_price():
+    cache = RateCache(FileRateProvider("unused"), max_age=60)
+    cache.set_snapshot(RateSnapshot(50000.0, time.time() - 61, "file"))
+    assert not cache.is_fresh()
+    assert cache.btc_price(15) is None
+
+
+def test_convert_rounds_half_up():
+    assert convert_usd_to_btc(1, 3, decimals=4) == 0.3333
+    assert convert_usd_to_btc(2, 3, decimals=4) == 0.6667
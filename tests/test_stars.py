@@ -0,0 +1,110 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+USER_ID = 42
+
+
+class Recorder:
+    """Асинхронная заглушка методов Telegram: запоминает аргументы вызовов."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "DB_PATH", str(tmp_path / "bot.db"))
+    bot.setup_database()
+    bot.add_initial_services()
+    bot.load_service_catalog()
+    conn = sqlite3.connect(bot.DB_PATH)
+    conn.execute("INSERT INTO orders (user_id, service_id, payment_method) VALUES (?, 1, 'STARS')", (USER_ID,))
+    conn.commit()
+    conn.close()
+    return bot.DB_PATH
+
+
+def order_row(db_path, order_id=1):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute("SELECT status, payment_proof FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def pre_checkout(payload, user_id=USER_ID, currency="XTR", amount=1000):
+    query = SimpleNamespace(invoice_payload=payload, from_user=SimpleNamespace(id=user_id),
+                            currency=currency, total_amount=amount, answer=Recorder())
+    asyncio.run(bot.stars_pre_checkout(SimpleNamespace(pre_checkout_query=query), None))
+    return query.answer.calls[0][1]
+
+
+def successful_payment(payload, charge_id="charge-1"):
+    payment = SimpleNamespace(invoice_payload=payload, telegram_payment_charge_id=charge_id, total_amount=1000)
+    message = SimpleNamespace(successful_payment=payment, reply_text=Recorder())
+    update = SimpleNamespace(
+        message=message,
+        effective_user=SimpleNamespace(id=USER_ID, mention_markdown_v2=lambda: "[user](tg://user?id=42)"),
+    )
+    context = SimpleNamespace(bot=SimpleNamespace(send_message=Recorder()))
+    asyncio.run(bot.stars_successful_payment(update, context))
+    return message.reply_text.calls, context.bot.send_message.calls
+
+
+def test_payload_round_trip():
+    assert bot.parse_stars_payload(bot.make_stars_payload(7, 3, USER_ID)) == (7, 3, USER_ID)
+
+
+@pytest.mark.parametrize("payload", ["", "order:1:2", "refund:1:2:3", "order:a:2:3"])
+def test_parse_rejects_malformed_payload(payload):
+    assert bot.parse_stars_payload(payload) is None
+
+
+def test_pre_checkout_accepts_matching_invoice(db):
+    assert pre_checkout(bot.make_stars_payload(1, 1, USER_ID)) == {"ok": True}
+
+
+@pytest.mark.parametrize("payload, overrides", [
+    ("garbage", {}),
+    (bot.make_stars_payload(1, 1, USER_ID), {"user_id": USER_ID + 1}),
+    (bot.make_stars_payload(1, 1, USER_ID), {"currency": "USD"}),
+    (bot.make_stars_payload(1, 1, USER_ID), {"amount": 999}),
+    (bot.make_stars_payload(1, 999, USER_ID), {}),
+])
+def test_pre_checkout_rejects_invalid_invoice(db, payload, overrides):
+    answer = pre_checkout(payload, **overrides)
+    assert answer["ok"] is False
+    assert answer["error_message"]
+
+
+def test_successful_payment_approves_order(db):
+    replies, admin_messages = successful_payment(bot.make_stars_payload(1, 1, USER_ID))
+    assert order_row(db) == ("approved", "charge-1")
+    assert len(replies) == 1
+    assert [kwargs["chat_id"] for _, kwargs in admin_messages] == bot.ADMIN_IDS
+
+
+def test_repeated_payment_update_is_ignored(db):
+    payload = bot.make_stars_payload(1, 1, USER_ID)
+    successful_payment(payload)
+    replies, admin_messages = successful_payment(payload)
+    assert order_row(db) == ("approved", "charge-1")
+    assert replies == [] and admin_messages == []
+
+
+def test_payment_for_closed_order_requests_refund(db):
+    conn = sqlite3.connect(db)
+    conn.execute("UPDATE orders SET status = 'declined' WHERE order_id = 1")
+    conn.commit()
+    conn.close()
+    replies, admin_messages = successful_payment(bot.make_stars_payload(1, 1, USER_ID), charge_id="charge-2")
+    assert order_row(db) == ("declined", None)
+    assert "возврат" in replies[0][0][0]
+    assert "charge-2" in admin_messages[0][1]["text"]